@@ -16,14 +16,19 @@
 # pyright: reportMissingImports=false,reportMissingModuleSource=false
 
 import argparse
+import functools
+import heapq
+import logging
 import os
 import re
+from collections import Counter
 
 import joblib
+import numpy as np
 import stanza
-from flask import Flask, jsonify, request
+from flask import Flask, abort, jsonify, request
 from mitreattack.stix20 import MitreAttackData
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
 # Define a set of POS tags corresponding to stop words (adjust as needed)
@@ -41,57 +46,135 @@ stop_words = {
     "X",  # other 'etc.'
 }
 
-# Use a set for faster membership checking
-stop_words_set = set(stop_words)
+# Text substitutions applied by preprocess, done in a single regex pass
+replacements = {
+    "<code>": " ",
+    "</code>": " ",
+    "XSS": "Cross-Site Scripting",
+    "DOS": "Denial of Service",
+}
+replacements_re = re.compile("|".join(re.escape(key) for key in replacements))
+
+# Compiled once; preprocess runs for every technique and every request
+citation_re = re.compile(r"\(Citation: [^)]+\)")
 
 stanza.download("en")  # Download English model for Stanza
 nlp = stanza.Pipeline(lang="en", processors="tokenize,mwt,pos,lemma,depparse")
-vectorizer = TfidfVectorizer()
+
+# Squared idf of a term found in only one of two documents (smooth_idf=True)
+unshared_idf_sq = (1 + np.log(1.5)) ** 2
+
 mitre_data = []  # type: ignore
+mitre_index = None  # type: ignore
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 
 def preprocess(text):
-    text = text.replace("<code>", " ").replace("</code>", " ")
-    text = text.replace("XSS", "Cross-Site Scripting")
-    text = text.replace("DOS", "Denial of Service")
-    return re.sub(r"\(Citation: [^)]+\)", "", text)
+    text = replacements_re.sub(lambda match: replacements[match.group(0)], text)
+    return citation_re.sub("", text)
 
 
 def process_document(doc):
+    # Collect the lemmas and the capitalized-word weight in a single walk of the doc
     tokens = []
+    weight = []
 
     for sent in doc.sentences:
         for word in sent.words:
-            if word.pos not in stop_words_set:
+            if word.pos not in stop_words:
                 tokens.append(word.lemma)
+                if word.text[0].isupper():
+                    weight.append(word.text)
 
-    return " ".join(tokens)
+    return " ".join(tokens), " ".join(weight)
 
 
-def calculate_capitalized_words_weight(doc):
-    weight = []
-    for sent in doc.sentences:
-        for word in sent.words:
-            if word.text[0].isupper() and word.pos not in stop_words_set:
-                weight.append(word.text)
-    return " ".join(weight)
+@functools.lru_cache(maxsize=4096)
+def analyze_cvetext(cvetext):
+    # The same CVE text is often mapped repeatedly; keep the Stanza results
+    cvedoc = nlp(preprocess(cvetext))
+    return process_document(cvedoc)
+
+
+def weight_document(doc):
+    processed_doc, words_weight = doc
+    return processed_doc.lower() + " " + words_weight.lower()
+
+
+def build_mitre_index(mitre_data):
+    """Count the terms of every MITRE doc once, so requests only count the CVE.
 
+    Returns None when the MITRE docs have no terms at all (e.g. no MITRE data),
+    since there is no vocabulary to fit.
+    """
+    vectorizer = CountVectorizer()
+    try:
+        techniques = vectorizer.fit_transform([weight_document((processed, words_weight)) for _, processed, words_weight in mitre_data])
+    except ValueError:
+        # CountVectorizer raises on an empty vocabulary
+        return None
 
-def calculate_similarity(doc1, doc2, vectorizer):
-    processed_doc1, words_weight1 = doc1
-    processed_doc2, words_weight2 = doc2
+    techniques = techniques.astype(np.float64)
+    techniques_sq = techniques.multiply(techniques)
 
-    weighted_doc1 = processed_doc1.lower() + " " + words_weight1.lower()
-    weighted_doc2 = processed_doc2.lower() + " " + words_weight2.lower()
+    return {
+        "vectorizer": vectorizer,
+        "analyzer": vectorizer.build_analyzer(),
+        "techniques": techniques,
+        "techniques_present": techniques.sign(),
+        "techniques_sq": techniques_sq,
+        "techniques_sq_total": np.asarray(techniques_sq.sum(axis=1)).ravel(),
+    }
 
-    tfidf_matrix = vectorizer.fit_transform([weighted_doc1, weighted_doc2])
-    text_similarity_matrix = cosine_similarity(tfidf_matrix, tfidf_matrix)
 
-    combined_similarity = text_similarity_matrix[0][1]
+def calculate_similarities(doc, mitre_index):
+    """Score doc against every MITRE doc in one batch.
 
-    return combined_similarity
+    Matches fitting a TfidfVectorizer on each (doc, mitre_doc) pair and taking
+    the cosine similarity of the two rows. With only two documents the
+    smoothed idf is 1 for shared terms and 1 + ln(3/2) for terms in just one
+    of them, so every pair can be scored from the prebuilt MITRE counts.
+
+    This relies on TfidfVectorizer's defaults: smooth_idf=True, norm="l2",
+    sublinear_tf=False, and the same lowercasing and token_pattern as the
+    CountVectorizer in build_mitre_index. Changing any of them needs the
+    algebra here redone; check_similarities catches a mismatch at startup.
+    """
+    weighted_doc = weight_document(doc)
+
+    query = mitre_index["vectorizer"].transform([weighted_doc]).astype(np.float64)
+    query_sq = query.multiply(query)
+    # Terms missing from the MITRE vocabulary never match, but still count towards the CVE norm
+    query_sq_total = sum(count * count for count in Counter(mitre_index["analyzer"](weighted_doc)).values())
+
+    # Shared terms have idf 1, so they only contribute to the dot product
+    dot = (mitre_index["techniques"] @ query.T).toarray().ravel()
+
+    # Squared idf-weighted norms: weight everything as unshared, then correct the shared terms
+    shared_query_sq = (mitre_index["techniques_present"] @ query_sq.T).toarray().ravel()
+    shared_techniques_sq = (mitre_index["techniques_sq"] @ query.sign().T).toarray().ravel()
+    query_norm_sq = unshared_idf_sq * query_sq_total - (unshared_idf_sq - 1) * shared_query_sq
+    techniques_norm_sq = unshared_idf_sq * mitre_index["techniques_sq_total"] - (unshared_idf_sq - 1) * shared_techniques_sq
+
+    norms = np.sqrt(query_norm_sq * techniques_norm_sq)
+    return np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0)
+
+
+def check_similarities(mitre_data, mitre_index):
+    """Compare calculate_similarities with TfidfVectorizer + cosine_similarity on one pair."""
+    # Pair the first doc with the wordiest one, which always has terms when an index exists
+    other_index = int(np.argmax(mitre_index["techniques_sq_total"]))
+    doc = mitre_data[0][1:]
+    other = mitre_data[other_index][1:]
+
+    tfidf_matrix = TfidfVectorizer().fit_transform([weight_document(doc), weight_document(other)])
+    expected = cosine_similarity(tfidf_matrix, tfidf_matrix)[0][1]
+    actual = calculate_similarities(doc, mitre_index)[other_index]
+
+    if not np.isclose(actual, expected):
+        raise RuntimeError(f"calculate_similarities gave {actual}, TfidfVectorizer gave {expected}")
 
 
 def load_mitre(nlp, mitre_data_file):
@@ -107,17 +190,17 @@ def load_mitre(nlp, mitre_data_file):
             mitre_attack_data = MitreAttackData(mitre_json)
 
             techniques = mitre_attack_data.get_techniques(remove_revoked_deprecated=True)
-            print(f"Retrieved {len(techniques)} ATT&CK techniques from {mitre_json}")
+            logger.info("Retrieved %d ATT&CK techniques from %s", len(techniques), mitre_json)
 
-            for i, technique in enumerate(techniques):
-                id = technique.external_references[0].external_id
+            ids = [technique.external_references[0].external_id for technique in techniques]
+            texts = [preprocess(f"Attack technique using {technique.name}. {technique.description}") for technique in techniques]
 
-                text = f"Attack technique using {technique.name}. {technique.description}"
-                print(f"Processing {id}")
+            # Run the whole set through Stanza in one batch rather than one pipeline call per technique
+            docs = nlp.bulk_process(texts)
 
-                doc = nlp(preprocess(text))
-                processed_doc = process_document(doc)
-                capitalized_words_weight = calculate_capitalized_words_weight(doc)
+            for id, doc in zip(ids, docs):
+                logger.debug("Processing %s", id)
+                processed_doc, capitalized_words_weight = process_document(doc)
 
                 mitre_data.append((id, processed_doc, capitalized_words_weight))
 
@@ -133,24 +216,28 @@ def load_mitre(nlp, mitre_data_file):
 def mitremap():
     # Get JSON payload
     data = request.get_json()
+    if not isinstance(data, dict):
+        abort(400, description="Expected a JSON object with a cvetext field")
 
     # Extract cvetext from the payload
     cvetext = data.get("cvetext", "")
-    cvedoc = nlp(preprocess(cvetext))
-    cvedoc_processed = process_document(cvedoc)
-    cvedoc_words_weight = calculate_capitalized_words_weight(cvedoc)
+    if not isinstance(cvetext, str):
+        abort(400, description="Expected a JSON object with a cvetext field")
+
+    # Nothing to score against, so skip the NLP pass
+    if mitre_index is None:
+        return jsonify({})
 
-    scoring = {}
+    cvedoc_processed, cvedoc_words_weight = analyze_cvetext(cvetext)
 
-    for id, mitre_processed, mitre_words_weight in mitre_data:
-        similarity_score = calculate_similarity((cvedoc_processed, cvedoc_words_weight), (mitre_processed, mitre_words_weight), vectorizer)
-        scoring[id] = similarity_score
+    similarity_scores = calculate_similarities((cvedoc_processed, cvedoc_words_weight), mitre_index)
+    scoring = {id: score for (id, _, _), score in zip(mitre_data, similarity_scores)}
 
     # Filter entries with float64 > 0.25
-    sorted_dict = {key: value for key, value in scoring.items() if isinstance(value, float) and value > 0.25}
+    sorted_dict = {key: value for key, value in scoring.items() if value > 0.25}
 
     if len(sorted_dict) < 2:
-        sorted_dict = dict(sorted(scoring.items(), key=lambda item: item[1], reverse=True)[:2])
+        sorted_dict = dict(heapq.nlargest(2, scoring.items(), key=lambda item: item[1]))
 
     sorted_dict = dict(sorted(sorted_dict.items(), key=lambda item: item[1], reverse=True))
     return jsonify(sorted_dict)
@@ -162,9 +249,14 @@ if __name__ == "__main__":
     parser.add_argument("--loaddata", action="store_true", help="Load data")
     args = parser.parse_args()
 
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
     mitre_data_file = "mitre.joblib"
     mitre_data = load_mitre(nlp, mitre_data_file)
 
     # Check if --loaddata flag is provided
     if not args.loaddata:
+        mitre_index = build_mitre_index(mitre_data)
+        if mitre_index is not None:
+            check_similarities(mitre_data, mitre_index)
         app.run()